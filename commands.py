@@ -1,9 +1,13 @@
-import file_ops
+# file_ops is imported when a command runs, not when main.py starts:
+# its imports (concurrent.futures pulls in logging) would slow down
+# ‘--help’ and argument errors.
 
 
 def init(args):
+    import file_ops
     file_ops.init_file_tree(treepath='.', tree_id=args.id)
 
 
 def sync(args):
+    import file_ops
     file_ops.sync_file_trees('.', args.path)
@@ -1,12 +1,33 @@
+import concurrent.futures
+import contextlib
+import errno
 import hashlib
-import io
+import itertools
 import json
 import os, os.path
 import shutil
+import threading
+import time
 import versionvectors
 
 
 META_FILE = '.vector-sync'
+CACHE_FILE = '.vector-sync-cache'
+# replace_file writes to its file's name + TMP_SUFFIX, then renames it.
+TMP_SUFFIX = '.tmp'
+# Names the program uses in a tree's root; forbidden elsewhere in the tree.
+RESERVED_NAMES = frozenset(name + suffix
+        for name in (META_FILE, CACHE_FILE) for suffix in ('', TMP_SUFFIX))
+CACHE_MIN_AGE_NS = 2 * 10**9
+COPY_CHUNK_SIZE = 2**30
+COPY_FILE_RANGE_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+        errno.EOPNOTSUPP}
+# The constructor of the file hash objects, see new_hash_obj.
+HASH_CTOR = hashlib.sha512
+HASH_BUFFER_SIZE = 2**20
+
+# Per-thread state: ‘hash_buffer’ is the memoryview hash_file reads into.
+_thread_data = threading.local()
 
 
 def check_file_hashes(h):
@@ -25,10 +46,11 @@ def check_file_hashes(h):
     """
     if type(h) is not dict:
         raise ValueError('file hashes is not dict')
-    if any(type(k) is not str for k in h):
-        raise ValueError('file hashes key is not str')
-    if any(type(v) is not str for v in h.values()):
-        raise ValueError('file hashes value is not str')
+    for k, v in h.items():
+        if type(k) is not str:
+            raise ValueError('file hashes key is not str')
+        if type(v) is not str:
+            raise ValueError('file hashes value is not str')
 
 
 def new_hash_obj():
@@ -39,51 +61,184 @@ def new_hash_obj():
     >>> new_hash_obj().name
     'sha512'
     """
-    return hashlib.sha512()
+    return HASH_CTOR()
 
 
 def hash_file(filename):
     """Computes the hexdigest of the file content."""
-    with open(filename, 'rb') as f:
-        h = new_hash_obj()
+    with open(filename, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            # Ask the kernel for aggressive readahead so the disk keeps
+            # reading the file while we hash what was read.
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        # Allocating and clearing the buffer for each file
+        # costs more than hashing a small file.
+        view = getattr(_thread_data, 'hash_buffer', None)
+        if view is None:
+            view = memoryview(bytearray(HASH_BUFFER_SIZE))
+            _thread_data.hash_buffer = view
+
+        h = HASH_CTOR()
         while True:
-            b = f.read(io.DEFAULT_BUFFER_SIZE)
-            if not b:
+            n = f.readinto(view)
+            if not n:
                 return h.hexdigest()
-            h.update(b)
+            h.update(view[:n])
 
 
-def hash_file_tree(path):
-    return _hash_file_tree(path, is_root=True)
+def hash_files(filenames, *, cancel=None):
+    """
+    Return the list of hexdigests for the iterable of files.
+
+    The files are hashed in parallel threads.
+    hashlib releases the GIL while hashing, as does reading a file.
+    Each file is queued for hashing as soon as ‘filenames’ yields it,
+    so hashing overlaps with producing the rest of the files.
+    If the threading.Event ‘cancel’ is set, raises CancelledError
+    without waiting for the queued files.
+    """
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = []
+        try:
+            for filename in filenames:
+                futures.append(executor.submit(hash_file, filename))
+            hashes = []
+            for f in futures:
+                _check_cancel(cancel)
+                hashes.append(f.result())
+            return hashes
+        except BaseException:
+            # On an error or Ctrl-C don't wait for the queued files.
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def _check_cancel(cancel):
+    """Raise CancelledError if the threading.Event ‘cancel’ is set."""
+    if cancel is not None and cancel.is_set():
+        raise concurrent.futures.CancelledError()
+
+
+def check_hash_cache(c):
+    """
+    Raise an exception if ‘c’ is not a hash cache.
 
+    A hash cache maps the path of a file to [size, mtime_ns, inode, hash].
 
-def _hash_file_tree(tree_path, *, is_root):
-    file_hashes = {}
+    >>> check_hash_cache([])
+    Traceback (most recent call last):
+    ValueError: hash cache is not dict
+    >>> check_hash_cache({5: [0, 0, 0, '']})
+    Traceback (most recent call last):
+    ValueError: hash cache key is not str
+    >>> check_hash_cache({'a': [0, 0, '']})
+    Traceback (most recent call last):
+    ValueError: invalid hash cache value
+    >>> check_hash_cache({'a': [0, '0', 0, '']})
+    Traceback (most recent call last):
+    ValueError: invalid hash cache value
+
+    >>> check_hash_cache({})
+    >>> check_hash_cache({'a/b': [3, 1600000000000000000, 12, 'the hash']})
+    """
+    if type(c) is not dict:
+        raise ValueError('hash cache is not dict')
+    for k, v in c.items():
+        if type(k) is not str:
+            raise ValueError('hash cache key is not str')
+        if (type(v) is not list or len(v) != 4 or type(v[0]) is not int
+                or type(v[1]) is not int or type(v[2]) is not int
+                or type(v[3]) is not str):
+            raise ValueError('invalid hash cache value')
 
-    children = list(os.scandir(tree_path))
 
-    for child in children:
-        child_path = os.path.join(tree_path, child.name)
+def hash_file_tree(path):
+    return hash_file_tree_cached(path, {})[0]
 
-        if child.name == META_FILE:
-            if is_root and child.is_file():
-                continue
-            raise Exception(f'forbidden tree item: {json.dumps(child_path)}')
 
-        if child.is_file():
-            file_hashes[child.name] = hash_file(child_path)
-            continue
+def hash_file_tree_cached(path, cache, *, cancel=None):
+    """
+    Return (file hashes, new hash cache) for the tree at ‘path’.
 
-        if child.is_dir():
-            for subpath, hash_val in _hash_file_tree(child_path,
-                    is_root=False).items():
-                file_hashes[os.path.join(child.name, subpath)] = hash_val
+    Files whose size, modification time and inode
+    match their entry in the hash cache are not read.
+    Raises CancelledError soon after the threading.Event ‘cancel’ is set.
+    """
+    check_hash_cache(cache)
 
-    if not file_hashes and not is_root:
-        raise Exception(f'forbidden empty directory: {json.dumps(tree_path)}')
+    start_ns = time.time_ns()
+    file_hashes = {}
+    new_cache = {}
+    to_hash = []
+
+    def walk_cache_misses():
+        """Fill in file_hashes from the cache, yield the other files."""
+        for subpath, filepath, st in _walk_file_tree(path):
+            _check_cancel(cancel)
+            key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = cache.get(subpath)
+            if entry is not None and entry[:3] == key:
+                file_hashes[subpath] = entry[3]
+            else:
+                to_hash.append(subpath)
+                yield filepath
+            # A file changed again within the file system's timestamp
+            # granularity can keep its mtime, so don't trust recent mtimes.
+            if st.st_mtime_ns < start_ns - CACHE_MIN_AGE_NS:
+                new_cache[subpath] = key
+
+    # Hash the files while walking the rest of the tree.
+    hashes = hash_files(walk_cache_misses(), cancel=cancel)
+    file_hashes.update(zip(to_hash, hashes))
+
+    for subpath, key in new_cache.items():
+        key.append(file_hashes[subpath])
+
+    # Both are built from str paths, int stats and str hexdigests:
+    # not checking them saves two passes over every file in the tree.
+    return file_hashes, new_cache
+
+
+def _walk_file_tree(root_path):
+    """
+    Yield (relative path, path, stat result) for each file in the tree.
 
-    check_file_hashes(file_hashes)
-    return file_hashes
+    The relative paths are relative to root_path.
+    """
+    # Directories left to list, as (path, path relative to the root + os.sep).
+    # The root's relative path is ''.
+    stack = [(root_path, '')]
+    while stack:
+        dir_path, prefix = stack.pop()
+        is_root = not prefix
+        is_empty = True
+
+        # Inode numbers roughly follow the on-disk layout (e.g. on ext4),
+        # so hashing files in inode order saves seeks on rotating disks.
+        # DirEntry.inode() comes from readdir and needs no syscall.
+        with os.scandir(dir_path) as it:
+            children = sorted(it, key=os.DirEntry.inode)
+
+        for child in children:
+            if child.name in RESERVED_NAMES:
+                if is_root and child.is_file():
+                    continue
+                raise Exception(
+                        f'forbidden tree item: {json.dumps(child.path)}')
+
+            if child.is_file():
+                yield prefix + child.name, child.path, child.stat()
+                is_empty = False
+            elif child.is_dir():
+                stack.append((child.path, prefix + child.name + os.sep))
+                is_empty = False
+
+        # A directory with a subdirectory is not empty:
+        # if the subdirectory has no files it is reported itself.
+        if is_empty and not is_root:
+            raise Exception(
+                    f'forbidden empty directory: {json.dumps(dir_path)}')
 
 
 def check_meta_data(md):
@@ -110,7 +265,7 @@ def check_meta_data(md):
     """
     if type(md) is not dict:
         raise ValueError('meta data is not dict')
-    if set(md.keys()) != {'id', 'version_vector', 'file_hashes'}:
+    if md.keys() != {'id', 'version_vector', 'file_hashes'}:
         raise ValueError('invalid meta data keys')
     if type(md['id']) is not str:
         raise ValueError('meta data id is not str')
@@ -118,10 +273,34 @@ def check_meta_data(md):
     check_file_hashes(md['file_hashes'])
 
 
+def replace_file(filepath, text, *, fsync=False):
+    """
+    Replace the content of filepath with text, atomically.
+
+    The text is written to filepath + TMP_SUFFIX which is then renamed
+    to filepath, so filepath never has partially written content.
+    If fsync is true the new content is on disk before the rename,
+    so a crash leaves either the old or the new content.
+    """
+    tmp_path = filepath + TMP_SUFFIX
+    try:
+        # Encode at once and bypass the text layer: one write syscall.
+        with open(tmp_path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
 def write_meta_data(md, filepath):
     check_meta_data(md)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(md, f, indent=2, sort_keys=True)
+    replace_file(filepath, json.dumps(md, indent=2, sort_keys=True),
+            fsync=True)
 
 
 def read_meta_data(filepath):
@@ -131,6 +310,27 @@ def read_meta_data(filepath):
     return md
 
 
+def write_hash_cache(cache, filepath):
+    check_hash_cache(cache)
+    replace_file(filepath, json.dumps(cache, sort_keys=True))
+
+
+def read_hash_cache(filepath):
+    """
+    Return the hash cache in filepath.
+
+    Returns an empty cache if the file can't be read or its content is
+    invalid, e.g. truncated by a crash: the cache is rebuilt from the files.
+    """
+    try:
+        with open(filepath, encoding='utf-8') as f:
+            cache = json.load(f)
+        check_hash_cache(cache)
+    except (OSError, ValueError):
+        return {}
+    return cache
+
+
 def init_file_tree(*, treepath, tree_id):
     filepath = os.path.join(treepath, META_FILE)
     # error out if the file already exists
@@ -142,7 +342,6 @@ def init_file_tree(*, treepath, tree_id):
         'version_vector': {},
         'file_hashes': {},
     }
-    check_meta_data(md)
     write_meta_data(md, filepath)
 
     print(f'Initialized {json.dumps(tree_id)} in {json.dumps(treepath)}.')
@@ -150,6 +349,7 @@ def init_file_tree(*, treepath, tree_id):
 
 def delete_up(filepath):
     """Delete the file and all empty parent directories."""
+    # Resolve symlinks: os.removedirs can't rmdir a symlinked directory.
     path = os.path.realpath(filepath)
     del filepath
 
@@ -157,14 +357,45 @@ def delete_up(filepath):
     # Because ‘path’ is an absolute not a relative path
     # ‘parent’ won't be the empty string.
     parent = os.path.dirname(path)
-    if not os.listdir(parent):
+    # Read at most one entry: os.listdir would read the whole directory.
+    # Don't let rmdir test it: it can fail first for other reasons,
+    # e.g. no write permission in the tree root's parent.
+    with os.scandir(parent) as it:
+        is_empty = next(it, None) is None
+    if is_empty:
         os.removedirs(parent)
 
 
-def copy_down(src_file, dest_file):
-    """Copy src_file to dest_file creating dest_file's parent if absent."""
-    dest_file = os.path.realpath(dest_file)
-    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+def copy_file_range(src_file, dest_file):
+    """
+    Copy src_file to dest_file in the kernel with os.copy_file_range.
+
+    This lets the file system share the data (reflink) or copy it
+    on the server side. Returns False, leaving dest_file in an unspecified
+    state, if the kernel or the file systems can't copy this file.
+    """
+    with open(src_file, 'rb') as src, open(dest_file, 'wb') as dest:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        try:
+            while True:
+                n = os.copy_file_range(src.fileno(), dest.fileno(),
+                        COPY_CHUNK_SIZE)
+                if not n:
+                    break
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in COPY_FILE_RANGE_UNSUPPORTED:
+                raise
+            return False
+    # Some file systems report success but copy nothing.
+    return copied == size
+
+
+def copy_file(src_file, dest_file):
+    """Copy src_file to dest_file. dest_file's parent must exist."""
+    if hasattr(os, 'copy_file_range') and copy_file_range(src_file, dest_file):
+        return
     shutil.copyfile(src_file, dest_file)
 
 
@@ -208,7 +439,7 @@ def check_tree_status(ts):
     """
     if type(ts) is not dict:
         raise ValueError('tree status is not dict')
-    if set(ts.keys()) != {'path', 'id', 'pre_vv',
+    if ts.keys() != {'path', 'id', 'pre_vv',
             'known_hashes', 'disk_hashes', 'post_vv'}:
         raise ValueError('invalid tree status keys')
     if type(ts['path']) is not str:
@@ -221,9 +452,24 @@ def check_tree_status(ts):
     versionvectors.check(ts['post_vv'])
 
 
-def read_tree_status(path):
+def read_tree_status(path, *, cancel=None):
+    """
+    Return the tree status of the tree at ‘path’.
+
+    Raises CancelledError soon after the threading.Event ‘cancel’ is set.
+    """
     md = read_meta_data(os.path.join(path, META_FILE))
-    disk_hashes = hash_file_tree(path)
+
+    cache_path = os.path.join(path, CACHE_FILE)
+    cache = read_hash_cache(cache_path)
+    disk_hashes, new_cache = hash_file_tree_cached(path, cache,
+            cancel=cancel)
+    if new_cache != cache:
+        # Only a cache: a tree the user can't write is still synced.
+        with contextlib.suppress(OSError):
+            write_hash_cache(new_cache, cache_path)
+    del cache_path, cache, new_cache
+
     post_vv = md['version_vector'] if disk_hashes == md['file_hashes'] \
             else versionvectors.advance(md['id'], md['version_vector'])
     ts = {
@@ -259,34 +505,48 @@ def ensure_meta_data(version_vector, file_hashes, tree_status):
             'version_vector': version_vector,
             'file_hashes': file_hashes,
     }
-    check_meta_data(md)
-
     write_meta_data(md, os.path.join(tree_status['path'], META_FILE))
     return True
 
 
-def format_tree_change(a, z):
-    """Return the change between file hashes ‘a’ and ‘z’ as a string."""
+def diff_file_hashes(a, z):
+    """
+    Return the (added, deleted, overwritten) paths from ‘a’ to ‘z’.
+
+    ‘a’ and ‘z’ are file hashes. Each element of the result is a set.
+
+    >>> diff_file_hashes({'x': '1', 'y': '2'}, {'y': '3', 'z': '4'})
+    ({'z'}, {'x'}, {'y'})
+    """
     check_file_hashes(a)
     check_file_hashes(z)
 
-    add_paths = {p for p in z if p not in a}
-    del_paths = {p for p in a if p not in z}
-    overwrite_paths = {p for p in a if p in z and a[p] != z[p]}
+    added, overwritten = set(), set()
+    for p, h in z.items():
+        old = a.get(p)
+        if old is None:
+            added.add(p)
+        elif old != h:
+            overwritten.add(p)
+    deleted = a.keys() - z.keys()
+
+    return added, deleted, overwritten
+
 
+def format_diff(added, deleted, overwritten):
+    """Return the result of diff_file_hashes as a string."""
     lines = []
     for paths, word, char in (
-            (add_paths, 'Add', '+'),
-            (del_paths, 'Delete', '-'),
-            (overwrite_paths, 'Overwrite', '≠'),
+            (added, 'Add', '+'),
+            (deleted, 'Delete', '-'),
+            (overwritten, 'Overwrite', '≠'),
             ):
         if not paths:
             continue
         if lines:
             lines.append('')
         lines.append(f'• {word}:')
-        for p in sorted(paths):
-            lines.append(f'{char} {json.dumps(p)}')
+        lines.extend(f'{char} {json.dumps(p)}' for p in sorted(paths))
 
     return '\n'.join(lines)
 
@@ -299,28 +559,61 @@ def ensure_files(*, read_from_ts, write_to_ts):
 
     r, w = (ts['disk_hashes'] for ts in (read_from_ts, write_to_ts))
 
-    if r == w:
+    # sync_file_trees also passes a tree as both source and destination.
+    if r is w or r == w:
         return False
 
-    print(format_tree_change(w, r))
+    added, deleted, overwritten = diff_file_hashes(w, r)
+
+    print(format_diff(added, deleted, overwritten))
     print()
     if not confirm(f'Change {json.dumps(write_to_ts["id"])}?'):
         raise Exception('canceled by the user')
 
-    for p in w:
-        if p not in r:
-            delete_up(os.path.join(write_to_ts['path'], p))
+    for p in deleted:
+        delete_up(os.path.join(write_to_ts['path'], p))
+
+    # Overwritten files are already in their directory.
+    # Make the directory of the added files once per directory.
+    for parent in {os.path.dirname(p) for p in added}:
+        if parent:
+            # Resolve symlinks: os.makedirs fails on a symlink
+            # to a directory deleted above.
+            os.makedirs(os.path.realpath(
+                os.path.join(write_to_ts['path'], parent)), exist_ok=True)
 
-    for p in r:
-        if p not in w or w[p] != r[p]:
-            copy_down(os.path.join(read_from_ts['path'], p),
-                    os.path.join(write_to_ts['path'], p))
+    for p in itertools.chain(added, overwritten):
+        copy_file(os.path.join(read_from_ts['path'], p),
+                os.path.join(write_to_ts['path'], p))
 
     return True
 
 
 def sync_file_trees(path_a, path_b):
-    a, b = (read_tree_status(p) for p in (path_a, path_b))
+    if os.path.samefile(path_a, path_b):
+        # Reading the same tree concurrently would race to write its cache.
+        a = read_tree_status(path_a)
+        b = dict(a, path=path_b)
+    else:
+        # The trees are often on different disks, so read them concurrently.
+        cancel = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(read_tree_status, p, cancel=cancel)
+                    for p in (path_a, path_b)]
+            try:
+                concurrent.futures.wait(futures,
+                        return_when=concurrent.futures.FIRST_EXCEPTION)
+            finally:
+                # On an error or Ctrl-C stop reading the other tree.
+                cancel.set()
+        # Raise the error that canceled the other tree, not CancelledError.
+        for f in futures:
+            e = f.exception()
+            if (e is not None
+                    and type(e) is not concurrent.futures.CancelledError):
+                raise e
+        a, b = (f.result() for f in futures)
+        del cancel, executor, futures, f, e
     del path_a, path_b
 
     if a['disk_hashes'] == b['disk_hashes']:
@@ -1,10 +1,12 @@
 import contextlib
+import errno
 import file_ops
 import hashlib
 import io
 import json
 import os, os.path
 import tempfile
+import time
 import unittest, unittest.mock
 import versionvectors
 
@@ -60,6 +62,73 @@ class TestHashFile(unittest.TestCase):
             f.flush()
             self.assertEqual(file_ops.hash_file(f.name), hash_bytes(b'test'))
 
+    def test_large_file(self):
+        content = bytes(range(256)) * 4099
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            self.assertEqual(file_ops.hash_file(f.name), hash_bytes(content))
+
+
+class TestHashFiles(unittest.TestCase):
+
+    def test_no_files(self):
+        self.assertEqual(file_ops.hash_files([]), [])
+
+    def test_files(self):
+        contents = [b'', b'first', b'second', b'first']
+        with tempfile.TemporaryDirectory() as d:
+            filenames = [os.path.join(d, str(i)) for i in range(len(contents))]
+            for filename, content in zip(filenames, contents):
+                with open(filename, 'xb') as f:
+                    f.write(content)
+
+            self.assertEqual(file_ops.hash_files(filenames),
+                    [hash_bytes(c) for c in contents])
+
+    def test_keeps_order(self):
+        # more files than worker threads
+        contents = [str(i).encode('utf-8') * i for i in range(200)]
+        with tempfile.TemporaryDirectory() as d:
+            filenames = [os.path.join(d, str(i)) for i in range(len(contents))]
+            for filename, content in zip(filenames, contents):
+                with open(filename, 'xb') as f:
+                    f.write(content)
+
+            self.assertEqual(file_ops.hash_files(filenames),
+                    [hash_bytes(c) for c in contents])
+
+    def test_missing_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaises(FileNotFoundError):
+                file_ops.hash_files([os.path.join(d, 'missing')])
+
+    def test_error_in_filenames(self):
+        def filenames(d):
+            filename = os.path.join(d, 'file')
+            with open(filename, 'xb') as f:
+                f.write(b'content')
+            yield filename
+            raise Exception('walk failed')
+
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaisesRegex(Exception, '^walk failed$'):
+                file_ops.hash_files(filenames(d))
+
+
+    def test_error_cancels_queued_files(self):
+        def hash_file(filename):
+            if filename == 'bad':
+                raise FileNotFoundError(filename)
+            time.sleep(0.01)
+            return filename
+
+        filenames = ['bad'] + [str(i) for i in range(1000)]
+        with unittest.mock.patch('file_ops.hash_file',
+                side_effect=hash_file) as hash_file_p:
+            with self.assertRaises(FileNotFoundError):
+                file_ops.hash_files(filenames)
+        self.assertLess(hash_file_p.call_count, len(filenames))
 
 class TestHashFileTree(unittest.TestCase):
 
@@ -88,6 +157,32 @@ class TestHashFileTree(unittest.TestCase):
                         f'^forbidden tree item: {json.dumps(bad_path)}$'):
                     file_ops.hash_file_tree(d)
 
+    def test_error_for_extra_cache_file_descendants(self):
+        for bad_tree, parent in (
+                ({file_ops.CACHE_FILE: {'a': b''}}, ''),
+                ({'subdir': {file_ops.CACHE_FILE: b''}}, 'subdir'),
+                ):
+            with tempfile.TemporaryDirectory() as d:
+                create_files(bad_tree, d)
+                bad_path = os.path.join(d, parent, file_ops.CACHE_FILE)
+                with self.assertRaisesRegex(Exception,
+                        f'^forbidden tree item: {json.dumps(bad_path)}$'):
+                    file_ops.hash_file_tree(d)
+
+    def test_error_for_extra_tmp_file_descendants(self):
+        for name in (file_ops.META_FILE + file_ops.TMP_SUFFIX,
+                file_ops.CACHE_FILE + file_ops.TMP_SUFFIX):
+            for bad_tree, parent in (
+                    ({name: {'a': b''}}, ''),
+                    ({'subdir': {name: b''}}, 'subdir'),
+                    ):
+                with tempfile.TemporaryDirectory() as d:
+                    create_files(bad_tree, d)
+                    bad_path = os.path.join(d, parent, name)
+                    with self.assertRaisesRegex(Exception,
+                            f'^forbidden tree item: {json.dumps(bad_path)}$'):
+                        file_ops.hash_file_tree(d)
+
     def test_error_for_empty_dirs(self):
         with tempfile.TemporaryDirectory() as d:
             create_files({'f': b'', 'nes': {'ted': {}}}, d)
@@ -107,6 +202,22 @@ class TestHashFileTree(unittest.TestCase):
                     pass
             self.assertEqual(file_ops.hash_file_tree(d), {})
 
+    def test_ignores_root_cache_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({file_ops.CACHE_FILE: b'{}', 'a': b'data'}, d)
+            self.assertEqual(file_ops.hash_file_tree(d),
+                    {'a': hash_bytes(b'data')})
+
+    def test_ignores_root_tmp_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({
+                file_ops.META_FILE + file_ops.TMP_SUFFIX: b'left by a crash',
+                file_ops.CACHE_FILE + file_ops.TMP_SUFFIX: b'{',
+                'a': b'data',
+            }, d)
+            self.assertEqual(file_ops.hash_file_tree(d),
+                    {'a': hash_bytes(b'data')})
+
     def test_hash_a_tree(self):
         tree = {
             file_ops.META_FILE: 'ignore me'.encode('utf-8'),
@@ -149,6 +260,129 @@ class TestHashFileTree(unittest.TestCase):
             })
 
 
+class TestHashFileTreeCached(unittest.TestCase):
+
+    def test_caches_old_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({'old': b'past', 'dir': {'new': b'now'}}, d)
+            old_path = os.path.join(d, 'old')
+            os.utime(old_path, ns=(0, 0))
+            old_stat = os.stat(old_path)
+
+            file_hashes, cache = file_ops.hash_file_tree_cached(d, {})
+            self.assertEqual(file_hashes, {
+                'old': hash_bytes(b'past'),
+                'dir/new': hash_bytes(b'now'),
+            })
+            # files modified just now are not cached
+            self.assertEqual(cache, {
+                'old': [old_stat.st_size, 0, old_stat.st_ino,
+                    hash_bytes(b'past')],
+            })
+
+    def test_uses_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({'a': b'alpha', 'b': b'beta'}, d)
+            for name in 'a', 'b':
+                os.utime(os.path.join(d, name), ns=(0, 0))
+            a_stat, b_stat = (os.stat(os.path.join(d, name))
+                    for name in ('a', 'b'))
+
+            cache = {
+                # matches the file on disk, so it is not read
+                'a': [a_stat.st_size, 0, a_stat.st_ino, 'cached a'],
+                # the size differs, so it is read
+                'b': [b_stat.st_size + 1, 0, b_stat.st_ino, 'cached b'],
+                'deleted': [0, 0, 0, 'cached deleted'],
+            }
+            file_hashes, new_cache = file_ops.hash_file_tree_cached(d, cache)
+            self.assertEqual(file_hashes, {
+                'a': 'cached a',
+                'b': hash_bytes(b'beta'),
+            })
+            self.assertEqual(new_cache, {
+                'a': [a_stat.st_size, 0, a_stat.st_ino, 'cached a'],
+                'b': [b_stat.st_size, 0, b_stat.st_ino, hash_bytes(b'beta')],
+            })
+
+    def test_bad_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaisesRegex(ValueError, '^hash cache is not dict$'):
+                file_ops.hash_file_tree_cached(d, None)
+
+
+class TestHashCache(unittest.TestCase):
+
+    def test_missing_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            self.assertEqual(file_ops.read_hash_cache(
+                os.path.join(d, file_ops.CACHE_FILE)), {})
+
+    def test_write_read(self):
+        cache = {'path/to/file': [7, 1600000000000000000, 42, 'the hash']}
+        with tempfile.TemporaryDirectory() as d:
+            filepath = os.path.join(d, file_ops.CACHE_FILE)
+            file_ops.write_hash_cache(cache, filepath)
+            self.assertEqual(file_ops.read_hash_cache(filepath), cache)
+
+    def test_bad_content(self):
+        for content in '', '{"a": "b"}', '{"a": [1, 2':
+            with tempfile.TemporaryDirectory() as d:
+                filepath = os.path.join(d, file_ops.CACHE_FILE)
+                with open(filepath, 'x', encoding='utf-8') as f:
+                    f.write(content)
+                self.assertEqual(file_ops.read_hash_cache(filepath), {})
+
+
+    def test_unreadable_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            filepath = os.path.join(d, file_ops.CACHE_FILE)
+            os.mkdir(filepath)
+            self.assertEqual(file_ops.read_hash_cache(filepath), {})
+
+class TestReplaceFile(unittest.TestCase):
+
+    def test_write_and_overwrite(self):
+        with tempfile.TemporaryDirectory() as d:
+            filepath = os.path.join(d, 'file')
+            for text in 'first', 'second':
+                file_ops.replace_file(filepath, text)
+                with open(filepath, encoding='utf-8') as f:
+                    self.assertEqual(f.read(), text)
+                self.assertEqual(os.listdir(d), ['file'])
+
+    def test_fsync(self):
+        with tempfile.TemporaryDirectory() as d:
+            filepath = os.path.join(d, 'file')
+            with unittest.mock.patch('os.fsync', spec_set=True) as fsync_p:
+                file_ops.replace_file(filepath, 'cache')
+                fsync_p.assert_not_called()
+                file_ops.replace_file(filepath, 'meta data', fsync=True)
+                fsync_p.assert_called_once()
+            with open(filepath, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'meta data')
+
+    def test_error_for_dir(self):
+        with tempfile.TemporaryDirectory() as d:
+            dirpath = os.path.join(d, 'dir')
+            os.mkdir(dirpath)
+            with self.assertRaises(IsADirectoryError):
+                file_ops.replace_file(dirpath, 'text')
+            self.assertEqual(os.listdir(d), ['dir'])
+
+    def test_keeps_old_content_on_error(self):
+        with tempfile.TemporaryDirectory() as d:
+            filepath = os.path.join(d, 'file')
+            file_ops.replace_file(filepath, 'old')
+            with unittest.mock.patch('os.replace', spec_set=True,
+                    side_effect=OSError('fail')):
+                with self.assertRaisesRegex(OSError, '^fail$'):
+                    file_ops.replace_file(filepath, 'new')
+            with open(filepath, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'old')
+            self.assertEqual(os.listdir(d), ['file'])
+
+
 class TestWriteMetaData(unittest.TestCase):
 
     def test_error_for_dir(self):
@@ -278,8 +512,33 @@ class TestDeleteUp(unittest.TestCase):
             file_ops.delete_up(child)
             self.assertEqual(os.listdir(a), ['z'])
 
+    def test_symlinked_dir(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({'real': {'x': b''}, 'tree': {'z': b''}}, d)
+            os.symlink(os.path.join(d, 'real'), os.path.join(d, 'tree', 'link'))
+
+            file_ops.delete_up(os.path.join(d, 'tree', 'link', 'x'))
+            self.assertEqual(os.listdir(d), ['tree'])
+
+    def test_symlinked_dir_not_empty(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({'real': {'x': b'', 'y': b''}, 'tree': {}}, d)
+            os.symlink(os.path.join(d, 'real'), os.path.join(d, 'tree', 'link'))
+
+            file_ops.delete_up(os.path.join(d, 'tree', 'link', 'x'))
+            self.assertEqual(os.listdir(os.path.join(d, 'real')), ['y'])
+
+    def test_parent_not_empty_and_not_removable(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({'x': b'', 'y': b''}, d)
+            # E.g. the tree root is in a directory the user can't write.
+            with unittest.mock.patch('os.rmdir',
+                    side_effect=PermissionError(errno.EACCES, 'denied')):
+                file_ops.delete_up(os.path.join(d, 'x'))
+            self.assertEqual(os.listdir(d), ['y'])
+
 
-class TestCopyDown(unittest.TestCase):
+class TestCopyFile(unittest.TestCase):
 
     def test_copy_to_dir(self):
         with tempfile.TemporaryDirectory() as a:
@@ -289,7 +548,7 @@ class TestCopyDown(unittest.TestCase):
                 msg = 'secret'
                 with open(x_path, 'x', encoding='utf-8') as f:
                     f.write(msg)
-                file_ops.copy_down(x_path, y_path)
+                file_ops.copy_file(x_path, y_path)
                 with open(y_path, encoding='utf-8') as f:
                     self.assertEqual(f.read(), msg)
 
@@ -298,39 +557,37 @@ class TestCopyDown(unittest.TestCase):
                 revised = 'untold'
                 with open(x_path, 'w', encoding='utf-8') as f:
                     f.write(revised)
-                file_ops.copy_down(x_path, y_path)
+                file_ops.copy_file(x_path, y_path)
                 with open(y_path, encoding='utf-8') as f:
                     self.assertEqual(f.read(), revised)
 
-    def test_creates_parent_dirs(self):
-        with tempfile.TemporaryDirectory() as a:
-            with tempfile.TemporaryDirectory() as m:
-                x_path = os.path.join(a, 'x')
-                y_path = os.path.join(m, 'n', 'o', 'p', 'y')
-                msg = 'nested'
-
-                with open(x_path, 'x', encoding='utf-8') as f:
-                    f.write(msg)
-                file_ops.copy_down(x_path, y_path)
-                with open(y_path, encoding='utf-8') as f:
-                    self.assertEqual(f.read(), msg)
-
-    def test_winding_path(self):
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'needs Linux')
+    def test_copy_file_range_unsupported(self):
         with tempfile.TemporaryDirectory() as d:
-            src_path = os.path.join(d, 'f')
-            msg = 'story'
-            with open(src_path, 'x', encoding='utf-8') as f:
-                f.write(msg)
-
-            dest_path = os.path.join(d, 'm', '..', 'n', 'g')
-            self.assertTrue(dest_path.index('/m/../n/') > 0)
-            file_ops.copy_down(src_path, dest_path)
-            # ‘os.makedirs('m/../n', exist_ok=True)’ creates dirs 'm' and 'n'.
-            # Ensure the code under test only creates 'n'.
-            self.assertEqual(set(os.listdir(d)), {'f', 'n'})
+            x_path, y_path = os.path.join(d, 'x'), os.path.join(d, 'y')
+            with open(x_path, 'x', encoding='utf-8') as f:
+                f.write('fallback')
+
+            with unittest.mock.patch('os.copy_file_range', spec_set=True,
+                    side_effect=OSError(errno.EXDEV, 'cross-device')):
+                self.assertFalse(file_ops.copy_file_range(x_path, y_path))
+                file_ops.copy_file(x_path, y_path)
+            with open(y_path, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'fallback')
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range'), 'needs Linux')
+    def test_copy_file_range_copies_nothing(self):
+        with tempfile.TemporaryDirectory() as d:
+            x_path, y_path = os.path.join(d, 'x'), os.path.join(d, 'y')
+            with open(x_path, 'x', encoding='utf-8') as f:
+                f.write('content')
 
-            with open(os.path.realpath(dest_path), encoding='utf-8') as f:
-                self.assertEqual(f.read(), msg)
+            with unittest.mock.patch('os.copy_file_range', spec_set=True,
+                    return_value=0):
+                self.assertFalse(file_ops.copy_file_range(x_path, y_path))
+                file_ops.copy_file(x_path, y_path)
+            with open(y_path, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'content')
 
 
 class TestReadTreeStatus(unittest.TestCase):
@@ -368,6 +625,45 @@ class TestReadTreeStatus(unittest.TestCase):
                 'post_vv': md['version_vector'],
             })
 
+    def test_writes_hash_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({'old': b'past'}, d)
+            old_path = os.path.join(d, 'old')
+            os.utime(old_path, ns=(0, 0))
+            file_ops.write_meta_data({
+                'id': 'A', 'version_vector': {}, 'file_hashes': {},
+            }, os.path.join(d, file_ops.META_FILE))
+
+            want = file_ops.hash_file_tree_cached(d, {})
+            file_ops.read_tree_status(d)
+            self.assertEqual(file_ops.read_hash_cache(
+                os.path.join(d, file_ops.CACHE_FILE)), want[1])
+
+    def test_hash_cache_not_writable(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({'old': b'past'}, d)
+            os.utime(os.path.join(d, 'old'), ns=(0, 0))
+            file_ops.write_meta_data({
+                'id': 'A', 'version_vector': {}, 'file_hashes': {},
+            }, os.path.join(d, file_ops.META_FILE))
+
+            with unittest.mock.patch('file_ops.write_hash_cache',
+                    side_effect=PermissionError(errno.EACCES, 'denied')):
+                ts = file_ops.read_tree_status(d)
+            self.assertEqual(ts['disk_hashes'], {'old': hash_bytes(b'past')})
+
+    def test_hash_cache_is_dir(self):
+        with tempfile.TemporaryDirectory() as d:
+            create_files({file_ops.CACHE_FILE: {'a': b''}}, d)
+            file_ops.write_meta_data({
+                'id': 'A', 'version_vector': {}, 'file_hashes': {},
+            }, os.path.join(d, file_ops.META_FILE))
+
+            bad_path = os.path.join(d, file_ops.CACHE_FILE)
+            with self.assertRaisesRegex(Exception,
+                    f'^forbidden tree item: {json.dumps(bad_path)}$'):
+                file_ops.read_tree_status(d)
+
     def test_tree_changed(self):
         tree = {'kitchen': {'sink': b'wash fruit', 'fridge': b'store fruit'}}
         with tempfile.TemporaryDirectory() as d:
@@ -464,11 +760,12 @@ class TestEnsureMetaData(unittest.TestCase):
             self.assertEqual(file_ops.read_meta_data(md_path), get_new_md())
 
 
-class TestFormatTreeChange(unittest.TestCase):
+class TestFormatDiff(unittest.TestCase):
 
     def test_no_change(self):
         for fh in {}, {'a/b/c': 'hash', 'y/z': 'some hash'}:
-            self.assertEqual('', file_ops.format_tree_change(fh, fh))
+            self.assertEqual('', file_ops.format_diff(
+                *file_ops.diff_file_hashes(fh, fh)))
 
     def test_change(self):
         a = {
@@ -507,7 +804,8 @@ class TestFormatTreeChange(unittest.TestCase):
 ≠ "data"
 ≠ "new\\nline"'''
 
-        self.assertEqual(file_ops.format_tree_change(a, z), want)
+        self.assertEqual(file_ops.format_diff(
+                *file_ops.diff_file_hashes(a, z)), want)
 
 
 class TestEnsureFiles(unittest.TestCase):
@@ -654,6 +952,28 @@ class TestEnsureFiles(unittest.TestCase):
                 del p
 
 
+    def test_creates_parent_dirs(self):
+        with tempfile.TemporaryDirectory() as read_from_dir:
+            create_files({'n': {'o': {'p': {'y': b'nested'}}}}, read_from_dir)
+            file_ops.write_meta_data({
+                'id': 'Pen', 'version_vector': {}, 'file_hashes': {},
+            }, os.path.join(read_from_dir, file_ops.META_FILE))
+            with tempfile.TemporaryDirectory() as write_to_dir:
+                file_ops.write_meta_data({
+                    'id': 'Paper', 'version_vector': {}, 'file_hashes': {},
+                }, os.path.join(write_to_dir, file_ops.META_FILE))
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    with unittest.mock.patch('builtins.input', spec_set=True,
+                            return_value='y'):
+                        self.assertTrue(file_ops.ensure_files(
+                            read_from_ts=file_ops.read_tree_status(
+                                read_from_dir),
+                            write_to_ts=file_ops.read_tree_status(
+                                write_to_dir)))
+                self.assertEqual(file_ops.hash_file_tree(write_to_dir),
+                        {'n/o/p/y': hash_bytes(b'nested')})
+
 class TestSyncFileTrees(unittest.TestCase):
 
     def test_already_synchronized(self):
@@ -708,6 +1028,58 @@ class TestSyncFileTrees(unittest.TestCase):
                     'post_vv': vv,
                 })
 
+    def test_same_tree(self):
+        with tempfile.TemporaryDirectory() as d:
+            tree = os.path.join(d, 'tree')
+            os.mkdir(tree)
+            create_files({'a': b'data'}, tree)
+            file_ops.write_meta_data({
+                'id': 'Tree', 'version_vector': {}, 'file_hashes': {},
+            }, os.path.join(tree, file_ops.META_FILE))
+            link = os.path.join(d, 'link')
+            os.symlink(tree, link)
+
+            for path_b in tree, link:
+                with unittest.mock.patch('file_ops.read_tree_status',
+                        wraps=file_ops.read_tree_status) as read_tree_status:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        file_ops.sync_file_trees(tree, path_b)
+                read_tree_status.assert_called_once_with(tree)
+
+                stdout = io.StringIO()
+                with contextlib.redirect_stdout(stdout):
+                    file_ops.sync_file_trees(tree, path_b)
+                self.assertEqual(stdout.getvalue(),
+                        '"Tree" and "Tree" are already synchronized.\n')
+
+    def test_error_stops_reading_other_tree(self):
+        with tempfile.TemporaryDirectory() as a:
+            create_files({'sub': {file_ops.META_FILE: b''}}, a)
+            file_ops.write_meta_data({
+                'id': 'A', 'version_vector': {}, 'file_hashes': {},
+            }, os.path.join(a, file_ops.META_FILE))
+            with tempfile.TemporaryDirectory() as b:
+                create_files({str(i): b'' for i in range(1000)}, b)
+                file_ops.write_meta_data({
+                    'id': 'B', 'version_vector': {}, 'file_hashes': {},
+                }, os.path.join(b, file_ops.META_FILE))
+
+                hash_file = file_ops.hash_file
+                def slow_hash_file(filename):
+                    time.sleep(0.01)
+                    return hash_file(filename)
+
+                bad_path = os.path.join(a, 'sub', file_ops.META_FILE)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    with unittest.mock.patch('file_ops.hash_file',
+                            side_effect=slow_hash_file) as hash_file_p:
+                        for path_a, path_b in (a, b), (b, a):
+                            with self.assertRaisesRegex(Exception,
+                                    '^forbidden tree item: '
+                                    + f'{json.dumps(bad_path)}$'):
+                                file_ops.sync_file_trees(path_a, path_b)
+                self.assertLess(hash_file_p.call_count, 2 * 1000)
+
     def test_same_files_different_metadata(self):
         tree = {
             'article': b'news\n',
@@ -1034,6 +1406,35 @@ class TestSyncFileTrees(unittest.TestCase):
             run(flip_args)
         del flip_args
 
+    def test_sync_into_symlinked_dir(self):
+        with tempfile.TemporaryDirectory() as d:
+            a, b = os.path.join(d, 'a'), os.path.join(d, 'b')
+            create_files({
+                'a': {'link': {'y': b'new'}},
+                'b': {},
+                'elsewhere': {'real': {'x': b'old'}},
+            }, d)
+            os.symlink(os.path.join(d, 'elsewhere', 'real'),
+                    os.path.join(b, 'link'))
+            file_ops.write_meta_data({
+                'id': 'A', 'version_vector': {'A': 1},
+                'file_hashes': {'link/y': hash_bytes(b'new')},
+            }, os.path.join(a, file_ops.META_FILE))
+            file_ops.write_meta_data({
+                'id': 'B', 'version_vector': {},
+                'file_hashes': {'link/x': hash_bytes(b'old')},
+            }, os.path.join(b, file_ops.META_FILE))
+
+            # Deleting ‘link/x’ removes the symlink's target directory.
+            with contextlib.redirect_stdout(io.StringIO()):
+                with unittest.mock.patch('builtins.input', spec_set=True,
+                        return_value='y'):
+                    file_ops.sync_file_trees(a, b)
+
+            self.assertEqual(file_ops.hash_file_tree(b),
+                    {'link/y': hash_bytes(b'new')})
+            self.assertEqual(file_ops.read_tree_status(b)['pre_vv'], {'A': 1})
+
     def test_diverged(self):
         tree_a = {'todo': b'tasks'}
         hashes_a = {'todo': hash_bytes(tree_a['todo'])}
@@ -17,10 +17,11 @@ def check(vv):
     """
     if type(vv) is not dict:
         raise ValueError('version vector is not dict')
-    if any(type(k) is not str for k in vv):
-        raise ValueError('version vector key is not str')
-    if any(type(val) is not int for val in vv.values()):
-        raise ValueError('version vector value is not int')
+    for k, val in vv.items():
+        if type(k) is not str:
+            raise ValueError('version vector key is not str')
+        if type(val) is not int:
+            raise ValueError('version vector value is not int')
 
 
 def less(a, b):
@@ -43,7 +44,8 @@ def less(a, b):
         check(vv)
     del vv
 
-    return a != b and all(k in b and a[k] <= b[k] for k in a)
+    return (a.keys() <= b.keys() and a != b
+            and all(a[k] <= b[k] for k in a))
 
 
 def join(a, b):
@@ -68,10 +70,12 @@ def join(a, b):
         check(vv)
     del vv
 
-    result = dict(a)
-    for k in b:
-        if k not in result or result[k] < b[k]:
-            result[k] = b[k]
+    # Counters only in a or only in b are already right;
+    # for IDs in both, keep a's counter if it is the larger one.
+    result = a | b
+    for k in a.keys() & b.keys():
+        if a[k] > b[k]:
+            result[k] = a[k]
 
     check(result)
     return result